@@ -1,11 +1,23 @@
 import streamlit as st
 import yfinance as yf
+from yfinance.exceptions import YFTickerMissingError
 from dotenv import load_dotenv
 import os
+import sys
 import json
 import time
 import uuid 
+import hashlib
+import threading
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from itertools import chain
+from collections import deque
+from datetime import date
+from concurrent.futures import ThreadPoolExecutor
+
+from cache import FileCache
 
 # --- Firebase Imports ---
 # We use the firebase-admin SDK for Python/Streamlit backend
@@ -13,12 +25,36 @@ import firebase_admin
 from firebase_admin import credentials, firestore
 
 # --- Configuration ---
+# Files next to app.py are located from here, independent of the working directory
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
 # Load environment variables
 load_dotenv()
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY") 
-GEMINI_API_URL = "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash-preview-09-2025:generateContent"
+GEMINI_API_URL = "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash-preview-09-2025:streamGenerateContent"
 MODEL = "gemini-2.5-flash-preview-09-2025"
 
+# On-disk cache for the Top Picks analysis (TTL in seconds, default 30 minutes)
+TOP_PICKS_CACHE_TTL = int(os.getenv("TOP_PICKS_CACHE_TTL", "1800"))
+top_picks_cache = FileCache(os.path.join(APP_DIR, ".cache", "top_picks"), ttl=TOP_PICKS_CACHE_TTL)
+
+# Number of recent messages always sent verbatim; older turns are folded into a rolling summary
+HISTORY_WINDOW = 10
+
+# Number of recent user queries listed in the sidebar
+RECENT_QUERIES_LIMIT = 50
+
+# Number of most recent messages read from Firestore when a session starts
+HISTORY_LOAD_LIMIT = 50
+
+# Once the in-memory history exceeds MESSAGES_MEMORY_LIMIT, it is cut back to the latest
+# MESSAGES_MEMORY_KEEP messages (older turns stay in Firestore and the rolling summary)
+MESSAGES_MEMORY_LIMIT = 60
+MESSAGES_MEMORY_KEEP = 40
+
+# Firestore allows at most 500 writes per batch
+FIRESTORE_BATCH_LIMIT = 500
+
 # Define the system prompt
 SYSTEM_PROMPT = """
 You are StockBot AI, a helpful, concise, and expert financial assistant.
@@ -28,57 +64,80 @@ If specific stock data is provided in the CONTEXT section of the user's prompt (
 Keep your answers professional, informative, and focused on the user's financial inquiry.
 """
 
+# The system prompt never changes, so its Gemini systemInstruction part is built once
+SYSTEM_INSTRUCTION = {"parts": [{"text": SYSTEM_PROMPT}]}
+
 # --- Firebase and Firestore Setup ---
-# Use mandatory global variables provided by the environment
-app_id = os.environ.get("__app_id", "default-app-id")
-firebase_config_json = os.environ.get("__firebase_config")
-initial_auth_token = os.environ.get("__initial_auth_token")
 
-# Initialize Firebase App only once per session
-if "db" not in st.session_state:
+@st.cache_resource(show_spinner=False)
+def init_firebase():
+    """Reads the environment and initializes Firebase once per process (not on every rerun).
+
+    Returns (db, app_id, initial_auth_token). Initialization errors are raised rather than
+    returned, so st.cache_resource does not cache a failure and the next session retries.
+    """
+    # Use mandatory global variables provided by the environment
+    app_id = os.environ.get("__app_id", "default-app-id")
+    firebase_config_json = os.environ.get("__firebase_config")
+    initial_auth_token = os.environ.get("__initial_auth_token")
+
+    # Attempt to initialize Firebase with environment credentials
+    if not firebase_admin._apps:
+        if firebase_config_json:
+            # Assuming the config is for a service account in this Python environment
+            config = json.loads(firebase_config_json)
+            cred = credentials.Certificate(config)
+            firebase_admin.initialize_app(cred, name=app_id)
+        else:
+            # Fallback to default initialization if config is missing
+            firebase_admin.initialize_app(name=app_id)
+    
+    db = firestore.client(app=firebase_admin.get_app(name=app_id))
+    return db, app_id, initial_auth_token
+
+# Only the per-session bits (user ID and history path) are stored in session state
+if "history_doc_path" not in st.session_state:
     try:
-        # Attempt to initialize Firebase with environment credentials
-        if not firebase_admin._apps:
-            if firebase_config_json:
-                # Assuming the config is for a service account in this Python environment
-                config = json.loads(firebase_config_json)
-                cred = credentials.Certificate(config)
-                firebase_admin.initialize_app(cred, name=app_id)
-            else:
-                # Fallback to default initialization if config is missing
-                firebase_admin.initialize_app(name=app_id)
-        
-        st.session_state.db = firestore.client(app=firebase_admin.get_app(name=app_id))
-        st.session_state.is_auth_ready = True
-        
+        db, app_id, initial_auth_token = init_firebase()
     except Exception as e:
         # st.warning(f"Could not initialize Firebase for persistence. Using session state only. Error: {e}")
-        st.session_state.is_auth_ready = False
-        st.session_state.db = None
-
-# Determine User ID and History Path
-if st.session_state.get("is_auth_ready"):
-    # Mocking user ID based on token presence or anonymous UUID
-    if initial_auth_token:
-        # Use a portion of the token as a pseudo-user ID for pathing
-        user_id = initial_auth_token[:16] 
-    elif "user_id" in st.session_state:
-        # Use existing anonymous ID if present
-        user_id = st.session_state.user_id
+        db, app_id, initial_auth_token = None, None, None
+    st.session_state.db = db
+    st.session_state.is_auth_ready = db is not None
+
+    # Determine User ID and History Path
+    if st.session_state.is_auth_ready:
+        # Mocking user ID based on token presence or anonymous UUID
+        if initial_auth_token:
+            # Use a portion of the token as a pseudo-user ID for pathing
+            user_id = initial_auth_token[:16] 
+        elif "user_id" in st.session_state:
+            # Use existing anonymous ID if present
+            user_id = st.session_state.user_id
+        else:
+            # Generate new anonymous ID and store it
+            user_id = str(uuid.uuid4())
+            st.session_state.user_id = user_id
+            
+        # Mandatory private data path structure
+        st.session_state.history_doc_path = f"artifacts/{app_id}/users/{user_id}/stockbot_history/chat_doc"
+        st.session_state.user_id_display = user_id # Store for display
     else:
-        # Generate new anonymous ID and store it
-        user_id = str(uuid.uuid4())
-        st.session_state.user_id = user_id
-        
-    # Mandatory private data path structure
-    HISTORY_DOC_PATH = f"artifacts/{app_id}/users/{user_id}/stockbot_history/chat_doc"
-    st.session_state.user_id_display = user_id # Store for display
-else:
-    HISTORY_DOC_PATH = None
-    st.session_state.user_id_display = "Anonymous (No Persistence)"
+        st.session_state.history_doc_path = None
+        st.session_state.user_id_display = "Anonymous (No Persistence)"
+
+HISTORY_DOC_PATH = st.session_state.history_doc_path
 
 
 # --- Streamlit UI Setup ---
+
+@st.cache_resource(show_spinner=False)
+def load_css():
+    """Reads style.css once per process and returns it wrapped in a <style> tag."""
+    css_path = os.path.join(APP_DIR, "style.css")
+    with open(css_path, "r", encoding="utf-8") as f:
+        return f"<style>{f.read()}</style>"
+
 st.set_page_config(page_title="📈 StockBot AI", page_icon="🤖", layout="wide")
 
 # Initialize analysis state
@@ -86,214 +145,439 @@ if "top_stocks_analysis" not in st.session_state:
     st.session_state["top_stocks_analysis"] = "Click 'Refresh Top Picks' to get today's analysis."
 
 # Apply custom styling for a clean, contrasting dark-on-light look
-st.markdown(
-    """
-    <style>
-    .main-header {
-        font-size: 2.5em;
-        font-weight: 700;
-        /* Header color white for dark background */
-        color: #FFFFFF; 
-        text-align: center;
-        padding-bottom: 20px;
-    }
-    .stSpinner {
-        color: #10b981; /* Tailwind Emerald */
-    }
-    /* Styling for the main chat input area */
-    .stChatInput > div > div > div > textarea {
-        border-radius: 0.75rem; 
-        border-color: #374151; 
-        background-color: #1f2937; 
-        color: #FFFFFF;
-    }
-    /* FIX: Sidebar styling (Dark Grey theme) */
-    [data-testid="stSidebar"] {
-        background-color: #1F2937; /* Dark Grey background */
-        color: #FFFFFF; /* White text for contrast */
-        border-right: 1px solid #374151; /* Dark border */
-        padding: 1.5rem;
-    }
-    /* Sidebar headers (White) */
-    [data-testid="stSidebar"] h2, [data-testid="stSidebar"] h3 {
-        color: #FFFFFF; 
-        font-weight: 600;
-    }
-    /* Sidebar text/subheader color (Slightly lighter grey) */
-    [data-testid="stSidebar"] p {
-        color: #D1D5DB; /* Light gray text */
-    }
-
-    .sidebar-button button {
-        background-color: #10B981 !important; /* Emerald 500 */
-        color: white !important;
-        font-weight: 600;
-        border-radius: 0.5rem;
-    }
-    .sidebar-button button:hover {
-        background-color: #059669 !important; /* Emerald 600 */
-    }
-    /* Styling for the previous queries buttons (Light grey on dark sidebar) */
-    .stButton>button {
-        background-color: #374151; /* Darker grey for buttons */
-        color: #F3F4F6; /* Very light text */
-        border: none;
-        padding: 4px 8px;
-        font-size: 0.9em;
-        margin-bottom: 4px;
-        text-align: left;
-        
-        /* THE NEW FIX: Ensures word wrap is prioritized */
-        word-break: normal; 
-        white-space: normal;
-        overflow-wrap: break-word; /* Additional assurance for long words */
-        height: auto; /* Allow height to adjust for word wrap */
-    }
-    .stButton>button:hover {
-        background-color: #4B5563; /* Medium grey on hover */
-        color: #F3F4F6;
-    }
-    /* Style for the Top Stocks analysis box - Ensures text is not wrapped in a clickable element */
-    .analysis-box {
-        background-color: #374151; /* Darker grey box */
-        border: 1px solid #4B5563;
-        padding: 10px;
-        border-radius: 0.5rem;
-        font-size: 0.9em;
-        color: #F3F4F6; /* Light text inside box */
-        /* Ensure non-interactivity */
-        pointer-events: none;
-        user-select: none;
-    }
-    </style>
-    """,
-    unsafe_allow_html=True
-)
+st.markdown(load_css(), unsafe_allow_html=True)
 
 st.markdown('<div class="main-header">🤖 StockBot AI — Chat About Stocks in Real Time (Powered by Gemini)</div>', unsafe_allow_html=True)
 st.markdown(f'<p style="text-align: center; color: #9ca3af; font-size: 0.9em;">User ID: <code>{st.session_state.user_id_display}</code></p>', unsafe_allow_html=True)
 
 
-# --- History Loading Function ---
+# --- Message Helpers ---
+# st.session_state["gemini_contents"] mirrors st.session_state["messages"][1:] in the Gemini
+# request format, so each turn only formats the new message instead of the whole history.
+# st.session_state["recent_queries"] holds the latest user queries (most recent first) for the sidebar.
+
+def to_gemini_content(msg):
+    """Converts a chat message into a Gemini content entry (role: user/model)."""
+    role = "user" if msg["role"] == "user" else "model"
+    return {"role": role, "parts": [{"text": msg["content"]}]}
+
+def set_messages(messages, recent_queries=None):
+    """Replaces the chat history (system prompt first) and rebuilds its derived state.
+
+    recent_queries (most recent first) is derived from messages unless given explicitly.
+    """
+    # Share one string object per role instead of one per loaded message
+    for msg in messages:
+        msg["role"] = sys.intern(msg["role"])
+    st.session_state["messages"] = messages
+    st.session_state["gemini_contents"] = [to_gemini_content(msg) for msg in messages[1:]]
+    if recent_queries is None:
+        recent_queries = [msg["content"] for msg in reversed(messages) if msg["role"] == "user"]
+    st.session_state["recent_queries"] = deque(recent_queries, maxlen=RECENT_QUERIES_LIMIT)
+
+def append_message(role, content):
+    """Appends a message to the chat history and its preformatted Gemini content."""
+    # ts orders the message documents in Firestore
+    msg = {"role": sys.intern(role), "content": content, "ts": time.time()}
+    st.session_state["messages"].append(msg)
+    st.session_state["gemini_contents"].append(to_gemini_content(msg))
+    if role == "user":
+        st.session_state["recent_queries"].appendleft(content)
+
+def trim_messages():
+    """Bounds the in-memory chat history by dropping its oldest messages.
+
+    Only messages Firestore already has are dropped when persistence is enabled, and
+    every index into the history (persisted_count, summary_upto, pending saves and
+    summaries) is shifted to match.
+    """
+    messages = st.session_state["messages"]
+    if len(messages) <= MESSAGES_MEMORY_LIMIT:
+        return
+
+    dropped = len(messages) - 1 - MESSAGES_MEMORY_KEEP
+    if st.session_state.get("history_doc_ref"):
+        # A save in flight may still fail, so only count messages it does not include as stored
+        pending_save = st.session_state.get("pending_save")
+        stored_count = st.session_state.get("persisted_count", 1)
+        if pending_save and pending_save[1] is not None:
+            stored_count = pending_save[1]
+        dropped = min(dropped, stored_count - 1)
+    if dropped <= 0:
+        return
+
+    # messages[0] is the system prompt and is always kept
+    del messages[1:1 + dropped]
+    del st.session_state["gemini_contents"][:dropped]
+
+    def shift(index):
+        return max(1, index - dropped)
+
+    st.session_state["persisted_count"] = shift(st.session_state.get("persisted_count", 1))
+    st.session_state["summary_upto"] = shift(st.session_state.get("summary_upto", 1))
+    if st.session_state.get("pending_save") and st.session_state["pending_save"][1] is not None:
+        future, previous_count = st.session_state["pending_save"]
+        st.session_state["pending_save"] = (future, shift(previous_count))
+    if st.session_state.get("summary_future"):
+        future, upto = st.session_state["summary_future"]
+        st.session_state["summary_future"] = (future, shift(upto))
+
+# --- History Loading Functions ---
+# Each message is its own document in the "messages" subcollection of the chat document,
+# which itself only holds metadata (recent queries, rolling summary, last update).
+
+def _migrate_legacy_messages(doc_ref, legacy_messages):
+    """Moves messages from the old single-array chat document into the subcollection."""
+    db = st.session_state.db
+    messages_ref = doc_ref.collection("messages")
+    # Sequential timestamps preserve the array order and sort before any new message
+    base_ts = time.time() - len(legacy_messages)
+    migrated = [
+        {"role": msg["role"], "content": msg["content"], "ts": base_ts + i}
+        for i, msg in enumerate(legacy_messages)
+    ]
+
+    for i in range(0, len(migrated), FIRESTORE_BATCH_LIMIT):
+        batch = db.batch()
+        for msg in migrated[i:i + FIRESTORE_BATCH_LIMIT]:
+            batch.set(messages_ref.document(), msg)
+        batch.commit()
+    doc_ref.update({"messages": firestore.DELETE_FIELD})
+    return migrated
 
 def load_chat_history():
-    """Loads chat history from Firestore if auth is ready and history hasn't been loaded."""
+    """Loads the most recent chat messages from Firestore if auth is ready and history hasn't been loaded."""
     if st.session_state.get("is_auth_ready") and "history_loaded" not in st.session_state:
         try:
             doc_ref = st.session_state.db.document(HISTORY_DOC_PATH)
             doc = doc_ref.get()
-            
-            if doc.exists and doc.get("messages"):
-                loaded_messages = doc.get("messages")
-                # Ensure the system prompt is present and at the start
-                if not loaded_messages or loaded_messages[0].get("role") != "system":
-                    loaded_messages.insert(0, {"role": "system", "content": SYSTEM_PROMPT})
-                st.session_state["messages"] = loaded_messages
+            history = doc.to_dict() if doc.exists else {}
+
+            # Chats saved before the subcollection layout keep an inline "messages" array
+            legacy_messages = [msg for msg in history.get("messages", []) if msg.get("role") != "system"]
+            if legacy_messages:
+                loaded_messages = _migrate_legacy_messages(doc_ref, legacy_messages)[-HISTORY_LOAD_LIMIT:]
             else:
-                # Initialize with system prompt if no doc
-                st.session_state["messages"] = [{"role": "system", "content": SYSTEM_PROMPT}]
+                # Only fetch the latest window, regardless of how long the chat is
+                query = doc_ref.collection("messages").order_by("ts").limit_to_last(HISTORY_LOAD_LIMIT)
+                loaded_messages = [snapshot.to_dict() for snapshot in query.get()]
+
+            # The system prompt is not persisted; it always starts the session history
+            set_messages(
+                [{"role": "system", "content": SYSTEM_PROMPT}] + loaded_messages,
+                history.get("recent_queries")
+            )
+
+            # Restore the rolling summary of older turns, if one was saved
+            st.session_state["history_summary"] = history.get("history_summary")
+            summary_until_ts = history.get("summary_until_ts")
+            covered = 0
+            if summary_until_ts is not None:
+                covered = sum(1 for msg in loaded_messages if msg.get("ts", 0) <= summary_until_ts)
+            st.session_state["summary_upto"] = 1 + covered
                 
+            # Everything loaded is already persisted; only later messages need saving
+            st.session_state["persisted_count"] = len(st.session_state["messages"])
             st.session_state.history_loaded = True
             st.session_state.history_doc_ref = doc_ref # Store reference for saving
 
         except Exception as e:
             # st.warning(f"Error loading chat history from Firestore: {e}. Starting new session.")
-            st.session_state["messages"] = [{"role": "system", "content": SYSTEM_PROMPT}]
+            set_messages([{"role": "system", "content": SYSTEM_PROMPT}])
             st.session_state.history_loaded = True
 
-# --- Stock Data Fetching Function (Remains the same) ---
+# --- Background Work ---
 
-def fetch_stock_data(symbol):
-    """Fetches key stock information using yfinance."""
+@st.cache_resource
+def background_pool():
+    """Shared thread pool for short network I/O (Firestore writes) that should not block the script thread."""
+    return ThreadPoolExecutor(max_workers=8)
+
+@st.cache_resource
+def llm_pool():
+    """Separate pool for Gemini calls, which can take up to a minute, so they never delay Firestore writes."""
+    return ThreadPoolExecutor(max_workers=4)
+
+@st.cache_resource
+def _inflight_requests():
+    """Process-wide map of in-flight futures by request key, shared by all sessions."""
+    return {}, threading.Lock()
+
+def coalesced(key, fn, *args):
+    """Runs fn(*args) on the Gemini pool, sharing one call between concurrent identical requests.
+
+    Callers that arrive while a request with the same key is still running wait on its
+    future instead of issuing their own call.
+    """
+    inflight, lock = _inflight_requests()
+    with lock:
+        future = inflight.get(key)
+        is_new = future is None
+        if is_new:
+            future = llm_pool().submit(fn, *args)
+            inflight[key] = future
+
+    if is_new:
+        def _forget(done_future):
+            with lock:
+                if inflight.get(key) is done_future:
+                    del inflight[key]
+        # Registered outside the lock since the callback runs immediately if fn already finished
+        future.add_done_callback(_forget)
+
+    return future.result()
+
+# --- History Saving Functions ---
+
+def check_pending_save(block=False):
+    """Surfaces the result of the last background Firestore write.
+
+    With block=True this waits for the write to finish, which keeps writes to the
+    chat history in order. A failed append rolls back persisted_count so the
+    messages are retried with the next save.
+    """
+    pending_save = st.session_state.get("pending_save")
+    if not pending_save:
+        return
+
+    future, previous_count = pending_save
+    if not block and not future.done():
+        return
+
+    del st.session_state["pending_save"]
     try:
-        stock = yf.Ticker(symbol.upper())
-        info = stock.info
-        
-        if info.get('regularMarketPrice') is None and info.get('currentPrice') is None:
-             raise ValueError("Symbol not found or data unavailable.")
-
-        data = {
-            "symbol": symbol.upper(),
-            "shortName": info.get("shortName", symbol.upper()),
-            "sector": info.get("sector", "N/A"),
-            "currentPrice": info.get("currentPrice", info.get("regularMarketPrice", "N/A")),
-            "fiftyTwoWeekHigh": info.get("fiftyTwoWeekHigh", "N/A"),
-            "fiftyTwoWeekLow": info.get("fiftyTwoWeekLow", "N/A"),
-            # Ensure the summary is safe to embed in the prompt
-            "longBusinessSummary": info.get("longBusinessSummary", "No business summary available."),
-            "marketCap": info.get("marketCap", "N/A")
-        }
-        return data
+        future.result()
     except Exception as e:
-        st.sidebar.error(f"Failed to fetch data for {symbol.upper()}: {e}")
-        return None
+        st.warning(f"Failed to save history to Firestore: {e}")
+        if previous_count is not None:
+            st.session_state["persisted_count"] = previous_count
+
+def save_chat_history():
+    """Adds messages not yet persisted to the Firestore messages subcollection in the background."""
+    doc_ref = st.session_state.get("history_doc_ref")
+    if not doc_ref:
+        return
+
+    check_pending_save(block=True)
+
+    persisted_count = st.session_state.get("persisted_count", 1)
+    pending = st.session_state["messages"][persisted_count:]
+    if not pending:
+        return
+
+    # One document per new message plus the metadata update, committed together
+    batch = st.session_state.db.batch()
+    messages_ref = doc_ref.collection("messages")
+    for msg in pending:
+        batch.set(messages_ref.document(), {
+            "role": msg["role"],
+            "content": msg["content"],
+            "ts": msg.get("ts", time.time())
+        })
+
+    metadata = {
+        "recent_queries": list(st.session_state["recent_queries"]),
+        "last_updated": firestore.SERVER_TIMESTAMP
+    }
+    # Persist the rolling summary (and the last message it covers) so long chats stay compact after a reload
+    summary_upto = st.session_state.get("summary_upto", 1)
+    if st.session_state.get("history_summary") and summary_upto > 1:
+        metadata["history_summary"] = st.session_state["history_summary"]
+        metadata["summary_until_ts"] = st.session_state["messages"][summary_upto - 1].get("ts")
+    # merge=True creates the chat document on first save and otherwise only updates these fields
+    batch.set(doc_ref, metadata, merge=True)
+
+    future = background_pool().submit(batch.commit)
+    st.session_state["persisted_count"] = len(st.session_state["messages"])
+    st.session_state["pending_save"] = (future, persisted_count)
+
+def reset_chat_history():
+    """Clears the chat in session state and in the Firestore history document."""
+    check_pending_save(block=True)
+    set_messages([{"role": "system", "content": SYSTEM_PROMPT}])
+    st.session_state["persisted_count"] = 1
+    # Forget the summary (and ignore any in-flight one) so it does not leak into the new chat
+    st.session_state["history_summary"] = None
+    st.session_state["summary_upto"] = 1
+    st.session_state.pop("summary_future", None)
+
+    doc_ref = st.session_state.get("history_doc_ref")
+    if doc_ref:
+        future = background_pool().submit(_clear_stored_history, st.session_state.db, doc_ref)
+        st.session_state["pending_save"] = (future, None)
+
+def _clear_stored_history(db, doc_ref):
+    """Deletes every stored message and resets the chat document (runs on the background pool)."""
+    batch, writes = db.batch(), 0
+    for msg_ref in doc_ref.collection("messages").list_documents():
+        batch.delete(msg_ref)
+        writes += 1
+        if writes == FIRESTORE_BATCH_LIMIT:
+            batch.commit()
+            batch, writes = db.batch(), 0
+    # Overwriting (no merge) also drops the saved summary
+    batch.set(doc_ref, {"recent_queries": [], "last_updated": firestore.SERVER_TIMESTAMP})
+    batch.commit()
+
+# --- Stock Data Fetching Function ---
+
+# Ticker objects keep everything they fetch, so each cached fetch builds a fresh one
+# (no network call) and the cache_data TTL decides when data is refreshed.
+
+@st.cache_data(ttl=300, max_entries=256, show_spinner=False)
+def _quote(sym):
+    """Returns name, price and 52-week range from one small chart request, cached for 5 minutes.
+
+    Every failure raises instead of returning a value, since cache_data would keep a
+    "not found" result for 5 minutes even when the cause was transient.
+    """
+    ticker = yf.Ticker(sym)
+    # A 5-day history is the lightest request; its metadata carries the quote fields we show.
+    # raise_errors=True lets network errors and rate limits through instead of an empty frame.
+    try:
+        history = ticker.history(period="5d", raise_errors=True)
+    except YFTickerMissingError as e:
+        # yfinance reports an unknown symbol and a failed timezone lookup (e.g. a network blip) the same way
+        raise ValueError("Symbol not found or data unavailable.") from e
+    meta = ticker.history_metadata or {}
+
+    last_price = meta.get("regularMarketPrice")
+    if last_price is None and not history.empty:
+        last_price = float(history["Close"].iloc[-1])
+    if last_price is None:
+        raise ValueError("Symbol not found or data unavailable.")
+
+    return {
+        "name": meta.get("shortName") or meta.get("longName") or sym,
+        "last_price": last_price,
+        "year_high": meta.get("fiftyTwoWeekHigh"),
+        "year_low": meta.get("fiftyTwoWeekLow")
+    }
 
-# --- Gemini API Call Function (Remains the same) ---
+@st.cache_data(ttl=3600, max_entries=256, show_spinner=False)
+def _company_profile(sym):
+    """Returns the sector and the first 500 characters of the business summary.
 
-def get_gemini_response(api_messages):
-    if not GEMINI_API_KEY:
-        return "⚠️ **Configuration Error:** The `GEMINI_API_KEY` is not set in your `.env` file."
+    This needs the heavy .info scrape, so it only runs when a chat turn injects stock context.
+    """
+    info = yf.Ticker(sym).info
+    return {
+        "sector": info.get("sector") or "N/A",
+        "summary": (info.get("longBusinessSummary") or "No business summary available.")[:500]
+    }
 
-    # Convert the messages into the format expected by the Gemini API (role: user/model)
-    gemini_contents = []
-    system_instruction_part = None
-    
-    for msg in api_messages:
-        role = "user" if msg["role"] == "user" else "model"
-        
-        # Handle the system prompt separately
-        if msg["role"] == "system":
-            system_instruction_part = msg["content"]
-            continue
+def _rounded(value, digits=2):
+    """Rounds quote floats for display, passing missing values through as "N/A"."""
+    return round(value, digits) if value is not None else "N/A"
 
-        gemini_contents.append({"role": role, "parts": [{"text": msg["content"]}]})
+def fetch_stock_data(symbol):
+    """Fetches key stock information using yfinance.
 
-    # Build the payload (Corrected for systemInstruction structure and adding Google Search tool)
+    Raises on failure; the caller reports the error where it renders the lookup.
+    """
+    quote = _quote(symbol.upper())
+
+    data = {
+        "symbol": symbol.upper(),
+        "shortName": quote["name"],
+        "currentPrice": _rounded(quote["last_price"]),
+        "fiftyTwoWeekHigh": _rounded(quote["year_high"]),
+        "fiftyTwoWeekLow": _rounded(quote["year_low"])
+    }
+    return data
+
+# --- Gemini API Call Functions ---
+
+@st.cache_resource
+def http():
+    """Returns a pooled HTTP session so TLS connections to Gemini are reused across calls."""
+    retry = Retry(
+        total=3,
+        backoff_factor=1,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=None, # Gemini calls are POSTs, which urllib3 does not retry by default
+        raise_on_status=False # Return the final error response so its status can be reported
+    )
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=retry))
+    return session
+
+class GeminiError(Exception):
+    """Raised when a Gemini call fails; the message is ready to show to the user."""
+
+def stream_gemini_response(gemini_contents):
+    """Streams the Gemini reply as text chunks via the server-sent events endpoint.
+
+    gemini_contents is a list of preformatted Gemini content entries (see to_gemini_content);
+    the system prompt is always sent as SYSTEM_INSTRUCTION. Failures raise GeminiError, also
+    when some text has already been yielded, so callers never mistake a cut-off reply for a
+    complete one.
+    """
+    if not GEMINI_API_KEY:
+        raise GeminiError("⚠️ **Configuration Error:** The `GEMINI_API_KEY` is not set in your `.env` file.")
+
+    # Build the payload (systemInstruction plus the Google Search tool)
     payload = {
         "contents": gemini_contents,
-        "systemInstruction": {
-            "parts": [
-                { "text": system_instruction_part }
-            ]
-        },
+        "systemInstruction": SYSTEM_INSTRUCTION,
         "tools": [
             { "google_search": {} }
         ]
     }
     
-    # We will implement a basic retry mechanism (exponential backoff)
-    max_retries = 3
-    for attempt in range(max_retries):
-        try:
-            response = requests.post(
-                f"{GEMINI_API_URL}?key={GEMINI_API_KEY}",
-                headers={"Content-Type": "application/json"},
-                json=payload
-            )
-            
-            response.raise_for_status()
-            
-            # Successful response
-            result = response.json()
+    # Retries with exponential backoff (including 429 rate limits) are handled by the session adapter
+    try:
+        # The context manager releases the pooled connection even if the caller stops iterating early
+        with http().post(
+            f"{GEMINI_API_URL}?alt=sse&key={GEMINI_API_KEY}",
+            headers={"Content-Type": "application/json"},
+            json=payload,
+            stream=True,
+            timeout=(5, 60)
+        ) as response:
             
-            # Extract the text
-            if result and result.get("candidates") and result["candidates"][0].get("content") and result["candidates"][0]["content"].get("parts"):
-                return result["candidates"][0]["content"]["parts"][0]["text"]
-            else:
-                return "⚠️ **API Response Error:** The Gemini API returned an empty or unexpected response structure."
-
-        except requests.exceptions.HTTPError as errh:
-            status_code = errh.response.status_code
-            if status_code == 429 and attempt < max_retries - 1:
-                wait_time = 2 ** attempt
-                # st.warning(f"Rate limit hit. Retrying in {wait_time} seconds...")
-                time.sleep(wait_time)
-            else:
-                return f"⚠️ **HTTP Error (Gemini):** Status {status_code}. Error: {errh.response.text}"
-        except requests.exceptions.RequestException as err:
-            return f"⚠️ **Connection Error (Gemini):** {err}"
+            # Read the error body while the response is still open
+            if not response.ok:
+                raise GeminiError(f"⚠️ **HTTP Error (Gemini):** Status {response.status_code}. Error: {response.text}")
             
-    return "⚠️ **Error:** Failed to get a response after multiple retries due to rate limiting."
+            # SSE is always UTF-8, but requests assumes ISO-8859-1 for text/* without a charset
+            response.encoding = "utf-8"
+
+            # Each SSE event is a "data: {...}" line holding a partial GenerateContentResponse
+            received_text = False
+            for line in response.iter_lines(decode_unicode=True):
+                if not line or not line.startswith("data:"):
+                    continue
+                chunk = json.loads(line[len("data:"):])
+                candidates = chunk.get("candidates") or [{}]
+                parts = candidates[0].get("content", {}).get("parts", [])
+                for part in parts:
+                    if part.get("text"):
+                        received_text = True
+                        yield part["text"]
+
+            if not received_text:
+                raise GeminiError("⚠️ **API Response Error:** The Gemini API returned an empty or unexpected response structure.")
+
+    except requests.exceptions.RequestException as err:
+        raise GeminiError(f"⚠️ **Connection Error (Gemini):** {err}") from err
+    except ValueError as err:
+        raise GeminiError(f"⚠️ **API Response Error:** Could not parse the Gemini stream: {err}") from err
+
+def get_gemini_response(gemini_contents):
+    """Returns the full Gemini reply as a single string. Raises GeminiError on failure."""
+    return "".join(stream_gemini_response(gemini_contents))
+
+def stream_for_display(chunks):
+    """Passes reply chunks through, ending with the error message if the stream fails."""
+    received_text = False
+    try:
+        for chunk in chunks:
+            received_text = True
+            yield chunk
+    except GeminiError as err:
+        # Put the error on its own paragraph after any partial reply
+        yield f"\n\n{err}" if received_text else str(err)
 
 # --- New Function: Fetch Top Stock Picks ---
 
@@ -302,14 +586,88 @@ def fetch_top_stocks_analysis():
     # This prompt asks for a concise, list-based output for easy sidebar display
     prompt = "What are 5 notable top-performing stocks today? Provide the ticker, the current price or change, and a very short, one-sentence reason based on market news. Format the output as a clean markdown list."
     
-    # We only send the system prompt and the specific request.
-    messages = [
-        {"role": "system", "content": SYSTEM_PROMPT},
-        {"role": "user", "content": prompt}
-    ]
+    # We only send the specific request (the system prompt is added by the API function).
+    contents = [to_gemini_content({"role": "user", "content": prompt})]
     
-    # Use the core API function
-    return get_gemini_response(messages)
+    # Reuse today's analysis if it was generated within the cache TTL
+    cache_key = f"{prompt}|{date.today().isoformat()}"
+    cached = top_picks_cache.get(cache_key)
+    if cached is not None:
+        return cached
+
+    # Concurrent refreshes (double clicks, other sessions) share a single Gemini call
+    request_key = "top_picks:" + hashlib.md5(cache_key.encode("utf-8")).hexdigest()
+    return coalesced(request_key, _generate_top_picks, contents, cache_key)
+
+def _generate_top_picks(contents, cache_key):
+    """Calls Gemini for the Top Picks analysis and stores a successful result on disk."""
+    # Use the core API function; failed or cut-off responses are shown but never cached
+    try:
+        analysis = get_gemini_response(contents)
+    except GeminiError as err:
+        return str(err)
+
+    top_picks_cache.set(cache_key, analysis)
+    return analysis
+
+# --- Chat History Window ---
+
+def summarize_history(previous_summary, messages):
+    """Folds older chat messages into a single summary string (runs on the Gemini pool)."""
+    transcript = "\n".join(f"{msg['role'].upper()}: {msg['content']}" for msg in messages)
+    prompt = (
+        "Summarize the following conversation between a user and StockBot AI in a short paragraph. "
+        "Keep the stocks, figures and conclusions that later questions may refer to.\n\n"
+    )
+    if previous_summary:
+        prompt += f"Summary of the conversation so far:\n{previous_summary}\n\n"
+    prompt += f"New messages:\n{transcript}"
+
+    return get_gemini_response([to_gemini_content({"role": "user", "content": prompt})])
+
+def refresh_history_summary(submit=False):
+    """Applies a finished background summary and, with submit=True, starts a new one if needed.
+
+    messages[1:summary_upto] are covered by history_summary. A new summary is requested
+    once more than 2 * HISTORY_WINDOW messages are outside it, so the prompt stays bounded
+    without summarizing on every turn.
+    """
+    pending = st.session_state.get("summary_future")
+    if pending:
+        future, upto = pending
+        if future.done():
+            del st.session_state["summary_future"]
+            # A failed call (GeminiError) keeps the previous summary and summary_upto
+            try:
+                summary = future.result()
+            except Exception:
+                summary = None
+            if summary:
+                st.session_state["history_summary"] = summary
+                st.session_state["summary_upto"] = upto
+
+    messages = st.session_state["messages"]
+    summary_upto = st.session_state.get("summary_upto", 1)
+    if submit and "summary_future" not in st.session_state and len(messages) - summary_upto > 2 * HISTORY_WINDOW:
+        upto = len(messages) - HISTORY_WINDOW
+        future = llm_pool().submit(
+            summarize_history,
+            st.session_state.get("history_summary"),
+            messages[summary_upto:upto]
+        )
+        st.session_state["summary_future"] = (future, upto)
+
+def build_api_contents():
+    """Returns Gemini contents for the rolling summary and the messages the summary does not cover."""
+    api_contents = []
+    if st.session_state.get("history_summary"):
+        api_contents.append(to_gemini_content({
+            "role": "user",
+            "content": f"SUMMARY OF EARLIER CONVERSATION: {st.session_state['history_summary']}"
+        }))
+    # gemini_contents[i] is messages[i + 1], since the system prompt has no content entry
+    api_contents.extend(st.session_state["gemini_contents"][st.session_state.get("summary_upto", 1) - 1:])
+    return api_contents
 
 # --- State Initialization & History Load ---
 
@@ -318,11 +676,17 @@ if "history_loaded" not in st.session_state and st.session_state.get("is_auth_re
     st.rerun() # Rerun once after loading history
 
 if "messages" not in st.session_state:
-    st.session_state["messages"] = [{"role": "system", "content": SYSTEM_PROMPT}]
+    set_messages([{"role": "system", "content": SYSTEM_PROMPT}])
+elif "gemini_contents" not in st.session_state or "recent_queries" not in st.session_state:
+    # Sessions started before the derived state existed only hold the plain messages
+    set_messages(st.session_state["messages"])
 
 if "stock_data" not in st.session_state:
     st.session_state["stock_data"] = None
 
+# Report any background Firestore write that failed since the last rerun
+check_pending_save()
+
 # Initialize the text value that can be set by sidebar clicks
 if "chat_input_text" not in st.session_state:
     st.session_state["chat_input_text"] = ""
@@ -330,84 +694,102 @@ if "chat_input_text" not in st.session_state:
 
 # --- Callback for Previous Query Click ---
 def set_chat_input(query):
-    # Set the text to be placed in the input box
+    # Set the text to be placed in the input box; the chat logic answers it on the rerun that follows the callback
     st.session_state["chat_input_text"] = query
-    # Immediately process the query by appending it to the messages and triggering a rerun
-    st.session_state["messages"].append({"role": "user", "content": query})
-    st.rerun()
+    # Immediately process the query by appending it to the messages
+    append_message("user", query)
 
 # --- Sidebar UI (Reordered & Collapsible) ---
+# Top Picks and Stock Lookup are fragments, so their buttons only rerun their own section.
 
 # 1. Previous Queries Section (Collapsible)
-with st.sidebar.expander("📝 Previous Queries", expanded=True):
-    # Filter and display user queries in the sidebar
-    user_queries = [msg["content"] for msg in st.session_state["messages"] if msg["role"] == "user"]
-    user_queries.reverse() # Show most recent first
-
-    # Use a container to make the list scrollable if it gets long
-    with st.container(height=250):
-        if user_queries:
-            for i, query in enumerate(user_queries):
-                # Using st.button inside st.container with a custom class for styling
-                st.button(
-                    query,
-                    key=f"query_btn_{i}",
-                    on_click=set_chat_input,
-                    args=(query,),
-                    use_container_width=True
-                )
-        else:
-            st.info("Start a conversation to see your history here!")
+# Filled in after the chat logic so it already lists the query answered in this run
+previous_queries_slot = st.sidebar.container()
+
+def render_previous_queries():
+    with st.expander("📝 Previous Queries", expanded=True):
+        # Display the bounded list of recent user queries (already most recent first)
+        user_queries = st.session_state["recent_queries"]
+
+        # Use a container to make the list scrollable if it gets long
+        with st.container(height=250):
+            if user_queries:
+                for i, query in enumerate(user_queries):
+                    # Using st.button inside st.container with a custom class for styling
+                    st.button(
+                        query,
+                        key=f"query_btn_{i}",
+                        on_click=set_chat_input,
+                        args=(query,),
+                        use_container_width=True
+                    )
+            else:
+                st.info("Start a conversation to see your history here!")
 
 st.sidebar.markdown("---")
 
 # 2. Top Stock Picks Today Section (Collapsible)
-with st.sidebar.expander("⭐ Top Stock Picks Today", expanded=False):
-    # Button to refresh the analysis
-    if st.button("Refresh Top Picks", key="refresh_picks_button", use_container_width=True):
-        with st.spinner("Fetching today's market analysis..."):
-            st.session_state["top_stocks_analysis"] = fetch_top_stocks_analysis()
-            st.rerun()
-    
-    # FIX: Use st.write/st.markdown and wrap in the non-interactive analysis-box div 
-    st.markdown('<div class="analysis-box">', unsafe_allow_html=True)
-    st.markdown(st.session_state["top_stocks_analysis"])
-    st.markdown('</div>', unsafe_allow_html=True)
+@st.fragment
+def top_picks_section():
+    with st.expander("⭐ Top Stock Picks Today", expanded=False):
+        # Button to refresh the analysis
+        if st.button("Refresh Top Picks", key="refresh_picks_button", use_container_width=True):
+            with st.spinner("Fetching today's market analysis..."):
+                st.session_state["top_stocks_analysis"] = fetch_top_stocks_analysis()
+        
+        # FIX: Use st.write/st.markdown and wrap in the non-interactive analysis-box div 
+        st.markdown('<div class="analysis-box">', unsafe_allow_html=True)
+        st.markdown(st.session_state["top_stocks_analysis"])
+        st.markdown('</div>', unsafe_allow_html=True)
+
+with st.sidebar:
+    top_picks_section()
 
 
 st.sidebar.markdown("---")
 
 # 3. Stock Lookup Section (Collapsible)
-with st.sidebar.expander("🔍 Stock Lookup", expanded=True):
-    symbol_input = st.text_input("Enter Stock Symbol (e.g., AAPL, TSLA, INFY):")
-
-    if st.button("Fetch and Set Context", key="fetch_button"):
-        if symbol_input:
-            with st.spinner(f"Fetching data for {symbol_input.upper()}..."):
-                data = fetch_stock_data(symbol_input)
-                st.session_state["stock_data"] = data
-                if data:
-                    st.success(f"Context set for {data['symbol']}!")
-                    st.subheader(data['shortName'])
-                    st.write(f"💰 **Current Price:** ${data['currentPrice']}")
-                    st.write(f"🏢 **Sector:** {data['sector']}")
-                    st.write(f"📅 **52W Range:** ${data['fiftyTwoWeekLow']} - ${data['fiftyTwoWeekHigh']}")
-                    
-                    # Clear chat history to reset context for the new stock
-                    st.session_state["messages"] = [{"role": "system", "content": SYSTEM_PROMPT}]
-                    st.rerun() 
-        else:
-            st.warning("Please enter a stock symbol.")
+@st.fragment
+def stock_lookup_section():
+    with st.expander("🔍 Stock Lookup", expanded=True):
+        symbol_input = st.text_input("Enter Stock Symbol (e.g., AAPL, TSLA, INFY):")
+
+        if st.button("Fetch and Set Context", key="fetch_button"):
+            if symbol_input:
+                with st.spinner(f"Fetching data for {symbol_input.upper()}..."):
+                    # Report errors here: fragments cannot write to st.sidebar directly
+                    try:
+                        data = fetch_stock_data(symbol_input)
+                    except Exception as e:
+                        st.error(f"Failed to fetch data for {symbol_input.upper()}: {e}")
+                        data = None
+                    st.session_state["stock_data"] = data
+                    if data:
+                        st.success(f"Context set for {data['symbol']}!")
+                        st.subheader(data['shortName'])
+                        st.write(f"💰 **Current Price:** ${data['currentPrice']}")
+                        st.write(f"📅 **52W Range:** ${data['fiftyTwoWeekLow']} - ${data['fiftyTwoWeekHigh']}")
+                        
+                        # Clear chat history to reset context for the new stock
+                        had_chat = len(st.session_state["messages"]) > 1
+                        reset_chat_history()
+                        # The chat area lives outside this fragment, so only rerun the app if it has to be cleared
+                        if had_chat:
+                            st.rerun() 
+            else:
+                st.warning("Please enter a stock symbol.")
 
-    # Display currently active context
-    if st.session_state["stock_data"]:
-        data = st.session_state["stock_data"]
-        st.markdown("---")
-        st.subheader("Active Context")
-        st.markdown(f"**Symbol:** `{data['symbol']}`")
-        st.markdown(f"**Company:** {data['shortName']}")
-        st.markdown(f"**Price:** **${data['currentPrice']}**")
-        st.markdown(f"**Sector:** {data['sector']}")
+        # Display currently active context
+        if st.session_state["stock_data"]:
+            data = st.session_state["stock_data"]
+            st.markdown("---")
+            st.subheader("Active Context")
+            st.markdown(f"**Symbol:** `{data['symbol']}`")
+            st.markdown(f"**Company:** {data['shortName']}")
+            st.markdown(f"**Price:** **${data['currentPrice']}**")
+
+with st.sidebar:
+    stock_lookup_section()
 
 st.sidebar.markdown("---")
 
@@ -420,13 +802,18 @@ for msg in st.session_state["messages"][1:]:
     else:
         st.chat_message("assistant").markdown(f"🤖 **StockBot:** {msg['content']}")
 
-# The input value from the sidebar click is handled by appending the message in set_chat_input and calling rerun.
+# The input value from the sidebar click is handled by appending the message in set_chat_input.
 # Now, st.chat_input is used normally without the 'value' argument.
 user_input = st.chat_input(
     "Ask StockBot about the active stock or anything else...", 
     key="chat_submission_key"
 )
 
+# A query clicked in the sidebar is answered just like one typed into the chat box
+if not user_input and st.session_state["chat_input_text"]:
+    user_input = st.session_state["chat_input_text"]
+st.session_state["chat_input_text"] = ""
+
 # Handle the case where a new value was submitted via the chat box
 if user_input:
     # 1. Append user input to session history (only if it's new input, not from sidebar button)
@@ -435,47 +822,57 @@ if user_input:
     
     # We compare the input to the last message to avoid duplicating if the user hits enter quickly after a button click
     if not st.session_state["messages"][-1]["content"] == user_input:
-        st.session_state["messages"].append({"role": "user", "content": user_input})
+        append_message("user", user_input)
+        # Show the new query (earlier messages were already rendered above)
+        st.chat_message("user").markdown(f"🧑‍💻 **You:** {user_input}")
 
-    # 2. Build the message list for the API call (including context if available)
-    api_messages = list(st.session_state["messages"]) # Copy the list
+    # 2. Build the bounded message list for the API call (including context if available)
+    refresh_history_summary()
+    api_contents = build_api_contents()
 
     # Inject stock context if available right before the user's latest query
     if st.session_state["stock_data"]:
         data = st.session_state["stock_data"]
+        # Sector and summary come from the heavy .info scrape, fetched only now that the chat needs them
+        try:
+            profile = _company_profile(data['symbol'])
+        except Exception:
+            profile = {"sector": "N/A", "summary": "No business summary available."}
+        # Ensure the summary is safe to embed in the prompt
+        summary = profile["summary"].replace('\n', ' ')
         context_message = f"""
         CONTEXT: The user's query relates to the currently active stock: {data['symbol']} ({data['shortName']}).
         Use the following real-time data for your analysis:
         - Current Price: ${data['currentPrice']}
         - 52-Week Range: ${data['fiftyTwoWeekLow']} - ${data['fiftyTwoWeekHigh']}
-        - Sector: {data['sector']}
-        - Business Summary (Partial): {data['longBusinessSummary'][:500].replace('\n', ' ')}...
+        - Sector: {profile['sector']}
+        - Business Summary (Partial): {summary}...
         """
         # Insert context as an extra user message right before the latest query
         # Find the index of the current user message (the last one)
-        last_user_index = len(api_messages) - 1
+        last_user_index = len(api_contents) - 1
         
         # Insert the context right before the last user message
-        api_messages.insert(last_user_index, {"role": "user", "content": context_message})
+        api_contents.insert(last_user_index, to_gemini_content({"role": "user", "content": context_message}))
 
-    # Show loading spinner while waiting for response
-    with st.spinner("StockBot is thinking... 💭"):
-        # Use the new Gemini API function
-        bot_reply = get_gemini_response(api_messages)
+    # Render the reply incrementally as chunks arrive
+    bot_prefix = "🤖 **StockBot:** "
+    with st.chat_message("assistant"):
+        bot_reply = st.write_stream(chain([bot_prefix], stream_for_display(stream_gemini_response(api_contents))))
+    bot_reply = bot_reply.removeprefix(bot_prefix)
 
     # 3. Append bot reply to session history
-    st.session_state["messages"].append({"role": "assistant", "content": bot_reply})
+    append_message("assistant", bot_reply)
     
-    # 4. Save history to Firestore
-    if st.session_state.get("history_doc_ref"):
-        try:
-            # We use set() with a map/dictionary to save the entire messages list
-            st.session_state.history_doc_ref.set({
-                "messages": st.session_state["messages"],
-                "last_updated": firestore.SERVER_TIMESTAMP
-            })
-        except Exception as e:
-            st.warning(f"Failed to save history to Firestore: {e}")
+    # 4. Summarize older turns in the background once the chat outgrows the window
+    refresh_history_summary(submit=True)
+
+    # 5. Append the new messages to the Firestore history (delta only, not the full list)
+    save_chat_history()
+
+    # 6. Keep the in-memory history bounded now that the new messages are stored
+    trim_messages()
 
-    # Rerun to clear the input field and display the new message
-    st.rerun()
+# The new messages are already on screen, so no extra rerun is needed; just list the latest query
+with previous_queries_slot:
+    render_previous_queries()
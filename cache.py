@@ -0,0 +1,54 @@
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+
+class FileCache:
+    """A small on-disk JSON cache with per-entry timestamps and a TTL.
+
+    Each entry is stored as `<directory>/<md5(key)>.json` containing
+    `{"ts": <unix time>, "value": <json value>}`, so cached values survive
+    Streamlit reruns and process restarts.
+    """
+
+    def __init__(self, directory, ttl=1800):
+        self.directory = directory
+        self.ttl = ttl
+
+    def _path(self, key):
+        digest = hashlib.md5(key.encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, f"{digest}.json")
+
+    def get(self, key):
+        """Returns the cached value for key, or None if missing, expired or unreadable."""
+        try:
+            with open(self._path(key), "r", encoding="utf-8") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        if time.time() - entry.get("ts", 0) > self.ttl:
+            return None
+        return entry.get("value")
+
+    def set(self, key, value):
+        """Stores value under key. Failures are ignored since the cache is best-effort."""
+        tmp_path = None
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            # A unique temp file per write, so concurrent writers never share one
+            with tempfile.NamedTemporaryFile(
+                "w", dir=self.directory, suffix=".tmp", delete=False, encoding="utf-8"
+            ) as f:
+                tmp_path = f.name
+                json.dump({"ts": time.time(), "value": value}, f)
+            # Atomic replace so concurrent readers never see a partial file
+            os.replace(tmp_path, self._path(key))
+        except (OSError, TypeError, ValueError):
+            if tmp_path:
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass